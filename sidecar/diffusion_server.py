@@ -23,11 +23,13 @@ Lifecycle:
   - Shuts down on SIGTERM, SIGINT, or all clients disconnect
 """
 import asyncio
+import contextlib
 import signal
 import sys
 import os
 import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 import numpy as np
 import cv2
 
@@ -42,6 +44,41 @@ from camera import Pipeline, COREML_DIR
 
 import websockets
 
+# libjpeg-turbo via PyTurboJPEG: SIMD Huffman + IDCT, 2-4x faster than
+# cv2.imdecode/imencode and returns bytes directly. Falls back to OpenCV
+# when the package or the libturbojpeg shared library is unavailable.
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
+# Numba is optional: when present, preprocessing runs as one fused
+# parallel pass instead of several numpy temporaries.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# orjson is optional; it parses the small control messages 2-3x faster.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch
+# the same exception either way. Replies still use json.dumps, since
+# orjson.dumps returns bytes, which would go out as a binary frame.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# uvloop is optional (not available on Windows); its event loop roughly
+# doubles asyncio throughput for this request/response WebSocket traffic.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# (width, height, min_size) -> libjpeg-turbo scaling factor, see _pick_scale()
+_scale_cache = {}
+
 
 pipeline = None
 
@@ -51,11 +88,71 @@ _alphas_cumprod = None
 _max_timestep = 0
 _current_strength = 0.5
 
+# (t_start, num_steps) -> precomputed DDIM schedule, see _ddim_schedule()
+_ddim_cache = {}
+
+# Reusable per-frame buffers for the advanced path, plus the normalization
+# LUT as raw fp16 bits. Allocated once in main_async() after the pipeline
+# loads; process_frame_advanced() overwrites them in place.
+_img_buf = None
+_norm_lut_bits = None
+_vae_out_lut = None
+_t_buf = None
+_latent_buf = None
+_x_buf = None
+_npred_buf = None
+_npred_uncond_buf = None
+_tmp_buf = None
+
 # CFG and multi-step parameters (runtime, no restart needed).
 _cfg_scale = 1.0
 _num_steps = 1
 _negative_embeds = None  # Encoded from "" at startup; updated via set_negative_prompt
 
+# True when the CoreML UNet was converted with a flexible batch dimension
+# (e.g. ct.EnumeratedShapes with batch 1 and 2). CFG then runs as a single
+# batch-2 predict instead of two passes. Detected in main_async().
+_unet_cfg_batch = False
+
+# Per-frame function specialized for the current CFG scale, step count and
+# strength; rebuilt by _rebuild_frame_fn() whenever one of them changes.
+_compiled_frame_fn = None
+
+# True while the prompt embedding is still moving toward its target.
+# Set by set_prompt; cleared by the advanced path once converged. The
+# scratch buffers for the convergence check are allocated in main_async().
+_prompt_dirty = True
+_embeds_diff = None
+_embeds_abs = None
+
+# Batch-2 UNet inputs for batched CFG, allocated in main_async(). Row 0 is
+# conditional and row 1 unconditional; _cfg_pos_src/_cfg_neg_src are the
+# embedding arrays last copied into _cfg_embeds, see _sync_cfg_embeds().
+_cfg_sample = None
+_cfg_t_buf = None
+_cfg_embeds = None
+_cfg_pos_src = None
+_cfg_neg_src = None
+
+# Worker for the unconditional CFG pass so it overlaps with the conditional
+# one. CoreML releases the GIL during predict(), letting ANE/GPU work and
+# input marshaling of the two passes run concurrently.
+_cfg_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cfg-uncond")
+
+# Serializes process_frame_advanced() across clients: it runs on worker
+# threads and shares the preallocated buffers above, and concurrent UNet
+# calls would only contend for the ANE anyway. Created in main_async() so
+# it belongs to the running event loop.
+#
+# Shared state while a frame runs on the worker thread:
+#  - The preallocated buffers above, pipeline._fixed_noise and the fast
+#    path's strength fields (pipeline._t_buf, _sqrt_a, _sqrt_1ma) are only
+#    changed under this lock (set_seed and set_strength take it).
+#  - Prompt/negative embeddings, settings and _compiled_frame_fn are only
+#    rebound from the event loop (atomic under the GIL); the worker reads
+#    each once per frame and picks up changes on the next one.
+_inference_lock = None
+
 
 def _compute_alphas_cumprod():
     """Compute the standard stable diffusion noise schedule.
@@ -86,183 +183,627 @@ def set_strength(strength):
     pipeline._sqrt_a = np.float16(np.sqrt(ap))
     pipeline._sqrt_1ma = np.float16(np.sqrt(1.0 - ap))
     pipeline._t_buf[0] = np.float16(t)
+    _rebuild_frame_fn()
 
 
-def process_frame_advanced(frame_bgr):
-    """Process a frame with optional CFG and multi-step denoising.
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _bgr_to_chw_bits(src, lut, dst):
+        # lut and dst are uint16 views of fp16 data: Numba's CPU target has
+        # no fp16 arithmetic, and a LUT copy only needs the bit pattern.
+        h, w = src.shape[0], src.shape[1]
+        for y in prange(h):
+            for x in range(w):
+                dst[0, 0, y, x] = lut[src[y, x, 2]]
+                dst[0, 1, y, x] = lut[src[y, x, 1]]
+                dst[0, 2, y, x] = lut[src[y, x, 0]]
+
+
+def bgr_to_chw_fp16(src, lut_bits, dst):
+    """Normalize an HxWx3 BGR uint8 image into a 1x3xHxW fp16 RGB buffer.
 
-    Fast path: when CFG <= 1 and steps == 1, delegates to pipeline.process_frame().
-    Advanced path: reimplements the processing loop with CFG double-pass and
-    DDIM multi-step denoising using the pipeline's CoreML models directly.
+    lut_bits is the 256-entry fp16 normalization LUT viewed as uint16.
+    Fuses the channel swap, LUT lookup, transpose and fp16 store into a
+    single pass when Numba is available.
     """
-    if _cfg_scale <= 1.0 and _num_steps <= 1:
-        return pipeline.process_frame(frame_bgr)
-
-    # --- Advanced path ---
-
-    # 1. Preprocess: crop to square + resize + normalize
-    h, w = frame_bgr.shape[:2]
-    if w > h:
-        off = (w - h) // 2
-        frame_bgr = frame_bgr[:, off:off + h]
-    elif h > w:
-        off = (h - w) // 2
-        frame_bgr = frame_bgr[off:off + w, :]
-
-    resized = cv2.resize(frame_bgr, (pipeline.render_size, pipeline.render_size))
-    rgb = resized[:, :, ::-1]  # BGR to RGB
-    img_buf = pipeline._norm_lut[rgb].transpose(2, 0, 1)[np.newaxis].astype(np.float16)
-
-    # 2. Smooth prompt transition (same as pipeline.process_frame)
-    diff = pipeline._target_embeds - pipeline._prompt_embeds
-    if np.abs(diff).max() > 1e-4:
-        pipeline._prompt_embeds = (
-            pipeline._prompt_embeds + pipeline._prompt_lerp_speed * diff
-        )
+    if njit is not None:
+        _bgr_to_chw_bits(src, lut_bits, dst.view(np.uint16))
+    else:
+        # One gather per channel straight into its CHW plane. mode="clip"
+        # skips bounds checking (uint8 indices always fit) and buffering.
+        lut = lut_bits.view(np.float16)
+        for c in range(3):
+            np.take(lut, src[:, :, 2 - c], out=dst[0, c], mode="clip")
+    return dst
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _chw_bits_to_bgr(src, lut, dst):
+        # src is the fp16 decoder output viewed as uint16; lut maps each
+        # fp16 bit pattern straight to a uint8 pixel value.
+        h, w = src.shape[2], src.shape[3]
+        for y in prange(h):
+            for x in range(w):
+                dst[y, x, 0] = lut[src[0, 2, y, x]]
+                dst[y, x, 1] = lut[src[0, 1, y, x]]
+                dst[y, x, 2] = lut[src[0, 0, y, x]]
+
+
+def _compute_vae_out_lut():
+    """Map every fp16 bit pattern to its uint8 pixel value.
+
+    Same math as the fp32 path, ((v + 1) * 127.5) clipped to 0..255 and
+    truncated, evaluated once for all 65536 inputs (NaN maps to 0). The
+    64 KB table turns VAE post-processing into a pure gather.
+    """
+    v = np.arange(1 << 16, dtype=np.uint32).astype(np.uint16).view(np.float16)
+    with np.errstate(invalid="ignore"):
+        out = (v.astype(np.float32) + 1.0) * 127.5
+    return np.nan_to_num(out, nan=0.0).clip(0, 255).astype(np.uint8)
 
-    # 3. VAE Encode
-    enc = pipeline.vae_encoder.predict({"image": img_buf})
-    clean = np.array(enc["latent"]).astype(np.float16)
 
-    # 4. Latent feedback from previous frame
-    if pipeline._prev_denoised is not None and pipeline.latent_feedback > 0:
-        fb = np.float16(pipeline.latent_feedback)
-        clean = (1.0 - fb) * clean + fb * pipeline._prev_denoised
+def vae_postprocess(src, lut, dst):
+    """Convert a 1x3xHxW fp16 RGB decoder output in [-1, 1] to an HxWx3
+    BGR uint8 image in one pass, using the table from _compute_vae_out_lut().
+    """
+    bits = src.view(np.uint16)
+    if njit is not None:
+        _chw_bits_to_bgr(bits, lut, dst)
+    else:
+        # Index with the channel-reversed HWC view of the bits so the gather
+        # writes the contiguous destination directly, BGR swap included.
+        np.take(lut, bits[0, ::-1].transpose(1, 2, 0), out=dst, mode="clip")
+    return dst
 
-    # 5. Add noise at start timestep
-    t_start = int(_current_strength * _max_timestep)
-    t_start = max(0, min(t_start, len(_alphas_cumprod) - 1))
-    ap_start = float(_alphas_cumprod[t_start])
-    sqrt_a_start = np.float16(np.sqrt(ap_start))
-    sqrt_1ma_start = np.float16(np.sqrt(1.0 - ap_start))
-    x = sqrt_a_start * clean + sqrt_1ma_start * pipeline._fixed_noise
 
-    # 6. Build DDIM timestep schedule: [t_start, ..., 0]
-    if _num_steps <= 1:
+def _norm_lut_as_bits(lut):
+    """Return the pipeline's uint8 -> fp16 normalization LUT as a flat,
+    contiguous 256-entry uint16 array of fp16 bit patterns, the form
+    bgr_to_chw_fp16() indexes directly.
+    """
+    lut = np.ascontiguousarray(lut, dtype=np.float16).reshape(-1)
+    if lut.shape != (256,):
+        raise ValueError(f"expected a 256-entry normalization LUT, got {lut.shape}")
+    return lut.view(np.uint16)
+
+
+def _model_accepts_batch(model, input_names, batch):
+    """Check whether a CoreML model's inputs all allow the given batch size."""
+    try:
+        inputs = {i.name: i for i in model.get_spec().description.input}
+    except Exception:
+        return False
+    for name in input_names:
+        if name not in inputs:
+            return False
+        arr = inputs[name].type.multiArrayType
+        flex = arr.WhichOneof("ShapeFlexibility")
+        if flex == "enumeratedShapes":
+            ok = any(s.shape and s.shape[0] == batch for s in arr.enumeratedShapes.shapes)
+        elif flex == "shapeRange":
+            r = arr.shapeRange.sizeRanges[0]
+            ok = r.lowerBound <= batch and (r.upperBound < 0 or batch <= r.upperBound)
+        else:
+            ok = bool(arr.shape) and arr.shape[0] == batch
+        if not ok:
+            return False
+    return True
+
+
+def _sync_cfg_embeds(pos_embeds, neg_embeds):
+    """Copy the prompt/negative embeddings into the batched CFG buffer.
+
+    Embeddings are replaced (not mutated) on prompt changes and each
+    transition step, so a copy is only needed when the object changes.
+    """
+    global _cfg_pos_src, _cfg_neg_src
+    if pos_embeds is not _cfg_pos_src:
+        np.copyto(_cfg_embeds[0], pos_embeds[0], casting="same_kind")
+        _cfg_pos_src = pos_embeds
+    if neg_embeds is not _cfg_neg_src:
+        np.copyto(_cfg_embeds[1], neg_embeds[0], casting="same_kind")
+        _cfg_neg_src = neg_embeds
+
+
+def _copy_output(dst, value):
+    """Copy a CoreML output into a preallocated fp16 buffer and return it."""
+    np.copyto(dst, value, casting="same_kind")
+    return dst
+
+
+def _ddim_schedule(t_start, num_steps):
+    """Return the DDIM timesteps and fp16 alpha coefficients for a run.
+
+    The schedule only depends on (t_start, num_steps), which change on
+    control messages rather than per frame, so results are memoized in
+    _ddim_cache. Returns (timesteps, sqrt_a_start, sqrt_1ma_start, sqrt_at,
+    sqrt_1mat, sqrt_an, sqrt_1man); the last four are per-step arrays.
+    """
+    key = (t_start, num_steps)
+    sched = _ddim_cache.get(key)
+    if sched is not None:
+        return sched
+
+    # Timestep schedule: [t_start, ..., 0]
+    if num_steps <= 1:
         timesteps = [t_start]
         next_ts = [0]
     else:
-        schedule = np.linspace(t_start, 0, _num_steps + 1).astype(int)
+        schedule = np.linspace(t_start, 0, num_steps + 1).astype(int)
         timesteps = schedule[:-1].tolist()
         next_ts = schedule[1:].tolist()
 
-    # 7. DDIM denoising loop with optional CFG
-    t_buf = np.empty((1,), dtype=np.float16)
-    neg_embeds = _negative_embeds
-    pos_embeds = pipeline._prompt_embeds
-
-    for t, t_next in zip(timesteps, next_ts):
-        t_buf[0] = np.float16(t)
-
-        # UNet forward pass (conditional)
-        u_cond = pipeline.unet.predict({
-            "sample": x, "timestep": t_buf,
-            "encoder_hidden_states": pos_embeds,
-        })
-        npred = np.array(u_cond["noise_pred"]).astype(np.float16)
-
-        # CFG: second UNet pass with negative/unconditional embeddings
-        if _cfg_scale > 1.0 and neg_embeds is not None:
-            u_uncond = pipeline.unet.predict({
-                "sample": x, "timestep": t_buf,
-                "encoder_hidden_states": neg_embeds,
-            })
-            npred_uncond = np.array(u_uncond["noise_pred"]).astype(np.float16)
-            npred = npred_uncond + np.float16(_cfg_scale) * (npred - npred_uncond)
-
-        # DDIM step
-        alpha_t = float(_alphas_cumprod[max(t, 0)])
-        alpha_next = float(_alphas_cumprod[t_next]) if t_next > 0 else 1.0
-        sqrt_at = np.float16(np.sqrt(alpha_t))
-        sqrt_1mat = np.float16(np.sqrt(1.0 - alpha_t))
-        sqrt_an = np.float16(np.sqrt(alpha_next))
-        sqrt_1man = np.float16(np.sqrt(1.0 - alpha_next))
-
-        pred_x0 = (x - sqrt_1mat * npred) / sqrt_at
-        x = sqrt_an * pred_x0 + sqrt_1man * npred
-
-    # 8. Store for latent feedback
-    pipeline._prev_denoised = x.copy()
-
-    # 9. VAE Decode
-    dec = pipeline.vae_decoder.predict({"latent": x})
-    r = np.array(dec["image"]).astype(np.float32).squeeze(0).transpose(1, 2, 0)
-    r = ((r + 1.0) * 127.5).clip(0, 255).astype(np.uint8)
-    if r.shape[0] != pipeline.output_size:
-        r = cv2.resize(r, (pipeline.output_size, pipeline.output_size))
-    return cv2.cvtColor(r, cv2.COLOR_RGB2BGR)
+    alpha_t = np.array([_alphas_cumprod[max(t, 0)] for t in timesteps])
+    alpha_next = np.array(
+        [_alphas_cumprod[t] if t > 0 else 1.0 for t in next_ts]
+    )
+    ap_start = float(_alphas_cumprod[t_start])
+    sched = (
+        timesteps,
+        np.float16(np.sqrt(ap_start)),
+        np.float16(np.sqrt(1.0 - ap_start)),
+        np.sqrt(alpha_t).astype(np.float16),
+        np.sqrt(1.0 - alpha_t).astype(np.float16),
+        np.sqrt(alpha_next).astype(np.float16),
+        np.sqrt(1.0 - alpha_next).astype(np.float16),
+    )
+    _ddim_cache[key] = sched
+    return sched
+
+
+def _build_frame_fn(cfg_scale, num_steps, strength):
+    """Build the per-frame processing function for the given settings.
+
+    Fast path: when CFG <= 1 and steps == 1, returns pipeline.process_frame.
+    Advanced path: returns a closure that reimplements the processing loop
+    with CFG double-pass and DDIM multi-step denoising using the pipeline's
+    CoreML models directly. The CFG branch, timestep schedule and fp16
+    coefficients are resolved here, once per settings change, instead of
+    on every frame.
+    """
+    if cfg_scale <= 1.0 and num_steps <= 1:
+        return pipeline.process_frame
+
+    t_start = int(strength * _max_timestep)
+    t_start = max(0, min(t_start, len(_alphas_cumprod) - 1))
+    (timesteps, sqrt_a_start, sqrt_1ma_start,
+     sqrt_at, sqrt_1mat, sqrt_an, sqrt_1man) = _ddim_schedule(t_start, num_steps)
+    # Per-step (timestep, sqrt(1-a_t), sqrt(a_t), sqrt(a_next), sqrt(1-a_next))
+    steps = [
+        (np.float16(t), sqrt_1mat[i], sqrt_at[i], sqrt_an[i], sqrt_1man[i])
+        for i, t in enumerate(timesteps)
+    ]
+    want_cfg = cfg_scale > 1.0
+    cfg = np.float16(cfg_scale)
+    size = pipeline.render_size
+    out_size = pipeline.output_size
+    unet_predict = pipeline.unet.predict
+    t_buf = _t_buf
+
+    def process_frame_advanced(frame_bgr):
+        global _prompt_dirty
+
+        # 1. Preprocess: crop to square + resize + normalize. Frames arriving
+        # from decode_jpeg() are usually already scaled close to render_size.
+        h, w = frame_bgr.shape[:2]
+        if w > h:
+            off = (w - h) // 2
+            frame_bgr = frame_bgr[:, off:off + h]
+        elif h > w:
+            off = (h - w) // 2
+            frame_bgr = frame_bgr[off:off + w, :]
+
+        if frame_bgr.shape[0] != size:
+            resized = cv2.resize(frame_bgr, (size, size))
+        else:
+            resized = frame_bgr
+        img_buf = bgr_to_chw_fp16(resized, _norm_lut_bits, _img_buf)
+
+        # 2. Smooth prompt transition (same as pipeline.process_frame).
+        # Skipped once converged until set_prompt marks it dirty again; the
+        # flag is cleared before reading the target so a concurrent
+        # set_prompt is never lost.
+        if _prompt_dirty:
+            _prompt_dirty = False
+            diff = np.subtract(
+                pipeline._target_embeds, pipeline._prompt_embeds, out=_embeds_diff
+            )
+            if np.abs(diff, out=_embeds_abs).max() > 1e-4:
+                _prompt_dirty = True
+                diff *= pipeline._prompt_lerp_speed
+                pipeline._prompt_embeds = pipeline._prompt_embeds + diff
+
+        # 3. VAE Encode
+        enc = pipeline.vae_encoder.predict({"image": img_buf})
+        clean = _copy_output(_latent_buf, enc["latent"])
+
+        # 4. Latent feedback from previous frame
+        if pipeline._prev_denoised is not None and pipeline.latent_feedback > 0:
+            fb = np.float16(pipeline.latent_feedback)
+            clean *= np.float16(1.0 - fb)
+            clean += np.multiply(pipeline._prev_denoised, fb, out=_tmp_buf)
+
+        # 5. Add noise at start timestep; DDIM schedule is [t_start, ..., 0]
+        x = np.multiply(clean, sqrt_a_start, out=_x_buf)
+        x += np.multiply(pipeline._fixed_noise, sqrt_1ma_start, out=_tmp_buf)
+
+        # 6. DDIM denoising loop with optional CFG
+        neg_embeds = _negative_embeds
+        pos_embeds = pipeline._prompt_embeds
+        use_cfg = want_cfg and neg_embeds is not None
+        batch_cfg = use_cfg and _unet_cfg_batch
+
+        # Each DDIM step consumes the previous step's output, so steps cannot
+        # be batched along the batch dimension; only the CFG pair is. Its
+        # embeddings are the same for every step, so sync them once.
+        if batch_cfg:
+            _sync_cfg_embeds(pos_embeds, neg_embeds)
+
+        for t, s_1mat, s_at, s_an, s_1man in steps:
+            t_buf[0] = t
+
+            if batch_cfg:
+                # CFG batching: cond + uncond in one batch-2 UNet dispatch
+                np.copyto(_cfg_sample[0], x[0])
+                np.copyto(_cfg_sample[1], x[0])
+                _cfg_t_buf[:] = t
+                out = unet_predict({
+                    "sample": _cfg_sample,
+                    "timestep": _cfg_t_buf,
+                    "encoder_hidden_states": _cfg_embeds,
+                })["noise_pred"]
+                npred = _copy_output(_npred_buf, out[:1])
+                npred_uncond = _copy_output(_npred_uncond_buf, out[1:])
+            else:
+                # CFG: unconditional UNet pass with negative embeddings, issued
+                # on the worker thread while the conditional pass runs here
+                if use_cfg:
+                    uncond_future = _cfg_pool.submit(unet_predict, {
+                        "sample": x, "timestep": t_buf,
+                        "encoder_hidden_states": neg_embeds,
+                    })
+
+                # UNet forward pass (conditional). The worker reads x and
+                # t_buf, so wait for it even if this pass raises; otherwise
+                # it outlives the inference lock.
+                try:
+                    u_cond = unet_predict({
+                        "sample": x, "timestep": t_buf,
+                        "encoder_hidden_states": pos_embeds,
+                    })
+                finally:
+                    if use_cfg:
+                        wait_futures([uncond_future])
+                npred = _copy_output(_npred_buf, u_cond["noise_pred"])
+
+                if use_cfg:
+                    u_uncond = uncond_future.result()
+                    npred_uncond = _copy_output(_npred_uncond_buf, u_uncond["noise_pred"])
+
+            if use_cfg:
+                npred -= npred_uncond
+                npred *= cfg
+                npred += npred_uncond
+
+            # DDIM step
+            # pred_x0 = (x - sqrt_1mat * npred) / sqrt_at, computed in place
+            x -= np.multiply(npred, s_1mat, out=_tmp_buf)
+            x /= s_at
+            # x = sqrt_an * pred_x0 + sqrt_1man * npred
+            x *= s_an
+            x += np.multiply(npred, s_1man, out=_tmp_buf)
+
+        # 7. Store for latent feedback (x is a reused buffer, so copy it out)
+        pipeline._prev_denoised = x.copy()
+
+        # 8. VAE Decode. The result gets a fresh buffer: the previous one
+        # may still be in a pipelined JPEG encode.
+        dec = pipeline.vae_decoder.predict({"latent": x})
+        image = np.asarray(dec["image"])
+        if image.dtype == np.float16:
+            h, w = image.shape[2:]
+            r = vae_postprocess(image, _vae_out_lut, np.empty((h, w, 3), np.uint8))
+        else:
+            r = image.astype(np.float32).squeeze(0).transpose(1, 2, 0)
+            r = ((r + 1.0) * 127.5).clip(0, 255).astype(np.uint8)
+            r = cv2.cvtColor(r, cv2.COLOR_RGB2BGR)
+        if r.shape[0] != out_size:
+            r = cv2.resize(r, (out_size, out_size))
+        return r
+
+    return process_frame_advanced
+
+
+def _rebuild_frame_fn():
+    """Re-specialize _compiled_frame_fn after a settings change."""
+    global _compiled_frame_fn
+    if pipeline is None or _alphas_cumprod is None:
+        return
+    _compiled_frame_fn = _build_frame_fn(_cfg_scale, _num_steps, _current_strength)
+
+
+def process_frame_advanced(frame_bgr):
+    """Process a frame with optional CFG and multi-step denoising, using
+    the function specialized for the current settings by _build_frame_fn().
+    """
+    return _compiled_frame_fn(frame_bgr)
+
+
+def _pick_scale(width, height, min_size):
+    """Pick the smallest libjpeg-turbo scaling factor (1/2, 1/4, 1/8, ...)
+    whose output still has a short side of at least min_size pixels.
+
+    Scaled decoding fuses the downsample into the IDCT, so a 1080p frame
+    headed for a 512 render comes out at 960x540 without a full-resolution
+    intermediate.
+    """
+    key = (width, height, min_size)
+    factor = _scale_cache.get(key)
+    if factor is None:
+        factor = (1, 1)
+        short = min(width, height)
+        for num, denom in _tj.scaling_factors:
+            if num >= denom:
+                continue
+            scaled = (short * num + denom - 1) // denom
+            if scaled >= min_size and num * factor[1] < factor[0] * denom:
+                factor = (num, denom)
+        _scale_cache[key] = factor
+    return factor
+
+
+def decode_jpeg(data, min_size=None):
+    """Decode JPEG bytes to a BGR uint8 array, or None if undecodable.
+
+    If min_size is given, the image may be decoded at a reduced scale as
+    long as its short side stays >= min_size.
+    """
+    if _tj is not None:
+        try:
+            factor = None
+            if min_size:
+                width, height, _, _ = _tj.decode_header(data)
+                factor = _pick_scale(width, height, min_size)
+            return _tj.decode(data, pixel_format=TJPF_BGR, scaling_factor=factor)
+        except (OSError, ValueError):
+            return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_jpeg(frame_bgr, quality=90):
+    """Encode a BGR uint8 array to JPEG.
+
+    Returns bytes, or a memoryview over OpenCV's output buffer on the
+    fallback path; websockets sends either without an extra copy.
+    """
+    if _tj is not None:
+        return _tj.encode(frame_bgr, quality=quality, pixel_format=TJPF_BGR)
+    _, jpeg = cv2.imencode(".jpg", frame_bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return memoryview(jpeg).cast("B")
+
+
+async def _encode_and_send(websocket, result_bgr):
+    """JPEG-encode a result frame on a worker thread, then send it."""
+    jpeg = await asyncio.to_thread(encode_jpeg, result_bgr, 90)
+    await websocket.send(jpeg)
+
+
+async def _run_inference(frame_bgr):
+    """Run process_frame_advanced() on a worker thread under _inference_lock.
+
+    CoreML releases the GIL during predict(), so the event loop keeps
+    serving commands meanwhile. A running thread cannot be interrupted:
+    if this coroutine is cancelled (client disconnect), the lock is held
+    until the thread finishes so no other inference touches the shared
+    buffers in the meantime.
+    """
+    async with _inference_lock:
+        job = asyncio.ensure_future(
+            asyncio.to_thread(process_frame_advanced, frame_bgr)
+        )
+        try:
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            while not job.done():
+                with contextlib.suppress(asyncio.CancelledError):
+                    await asyncio.wait({job})
+            raise
+
+
+async def _process_frames(websocket, frames):
+    """Run inference on frames from the queue and send the results.
+
+    Encoding and sending frame N runs as a task that overlaps with
+    decoding and inference of frame N+1. At most one send is in flight,
+    which keeps results in order.
+    """
+    pending_send = None
+    try:
+        while True:
+            message = await frames.get()
+            frame_bgr = await asyncio.to_thread(
+                decode_jpeg, message, pipeline.render_size
+            )
+            if frame_bgr is None:
+                continue
+            result_bgr = await _run_inference(frame_bgr)
+            if pending_send is not None:
+                await pending_send
+            pending_send = asyncio.create_task(
+                _encode_and_send(websocket, result_bgr)
+            )
+    finally:
+        if pending_send is not None:
+            pending_send.cancel()
+            with contextlib.suppress(
+                asyncio.CancelledError, websockets.exceptions.ConnectionClosed
+            ):
+                await pending_send
 
 
 async def handle_client(websocket):
-    """Handle a single WebSocket client connection."""
+    """Handle a single WebSocket client connection.
+
+    The receive loop only queues frames and answers commands; a separate
+    consumer task runs inference. The frame queue holds one entry and
+    newer frames replace older ones, so a slow model processes the latest
+    frame instead of falling further behind. If the consumer fails, the
+    connection is closed with 1011.
+    """
     global pipeline
     if pipeline is None:
         await websocket.close(1011, "Pipeline not initialized")
         return
 
+    frames = asyncio.Queue(maxsize=1)
+    consumer = asyncio.create_task(_process_frames(websocket, frames))
+    closing = []
+
+    def on_consumer_done(task):
+        # A failed consumer must end the connection on its own: the client
+        # sends its next frame only after a result, so it would otherwise
+        # wait forever. Closing ends the receive loop below, and the
+        # finally clause re-raises the error so websockets logs it.
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None and not isinstance(
+            exc, websockets.exceptions.ConnectionClosed
+        ):
+            closing.append(asyncio.ensure_future(
+                websocket.close(1011, "Frame processing failed")
+            ))
+
+    consumer.add_done_callback(on_consumer_done)
     try:
         async for message in websocket:
             if isinstance(message, bytes):
-                # Binary: JPEG image data
-                arr = np.frombuffer(message, dtype=np.uint8)
-                frame_bgr = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                if frame_bgr is None:
-                    continue
-                result_bgr = process_frame_advanced(frame_bgr)
-                _, jpeg = cv2.imencode(
-                    ".jpg", result_bgr, [cv2.IMWRITE_JPEG_QUALITY, 90]
-                )
-                await websocket.send(jpeg.tobytes())
+                # Binary: JPEG image data. Drop any frame still waiting.
+                if consumer.done():
+                    break
+                while not frames.empty():
+                    frames.get_nowait()
+                frames.put_nowait(message)
             elif isinstance(message, str):
                 # Text: JSON command
                 try:
-                    cmd = json.loads(message)
+                    cmd = _json_loads(message)
                     await handle_command(websocket, cmd)
                 except json.JSONDecodeError:
                     pass
     except websockets.exceptions.ConnectionClosed:
         pass
+    finally:
+        consumer.cancel()
+        if closing:
+            await closing[0]
+        with contextlib.suppress(
+            asyncio.CancelledError, websockets.exceptions.ConnectionClosed
+        ):
+            await consumer
+
+
+async def _h_set_prompt(ws, cmd):
+    global _prompt_dirty
+    prompt = cmd.get("prompt", "")
+    if prompt and pipeline is not None:
+        new_embed = pipeline._encode_single(prompt)
+        pipeline._target_embeds = new_embed
+        _prompt_dirty = True
+        pipeline._current_prompt = prompt
+        await ws.send(json.dumps({"type": "prompt_set", "prompt": prompt}))
+
+
+async def _h_set_feedback(ws, cmd):
+    if pipeline is not None:
+        pipeline.latent_feedback = float(cmd.get("value", 0.1))
+
+
+async def _h_set_strength(ws, cmd):
+    # set_strength() writes pipeline._t_buf in place and the fast path reads
+    # it (with _sqrt_a/_sqrt_1ma) on the inference thread.
+    async with _inference_lock:
+        set_strength(float(cmd.get("value", 0.5)))
+
+
+async def _h_set_lerp_speed(ws, cmd):
+    if pipeline is not None:
+        pipeline._prompt_lerp_speed = float(cmd.get("value", 0.05))
+
+
+async def _h_set_seed(ws, cmd):
+    if pipeline is not None:
+        seed = int(cmd.get("value", 42))
+        # Refill the existing noise buffer in place so anything holding a
+        # reference sees the new noise. standard_normal() can only write
+        # fp32/fp64 directly; fp16 latents go through one fp32 temporary.
+        # The inference thread reads this buffer, so refill under the lock.
+        noise = pipeline._fixed_noise
+        rng = np.random.default_rng(seed)
+        async with _inference_lock:
+            if noise.dtype in (np.float32, np.float64):
+                rng.standard_normal(out=noise, dtype=noise.dtype)
+            else:
+                np.copyto(
+                    noise,
+                    rng.standard_normal(noise.shape, dtype=np.float32),
+                    casting="same_kind",
+                )
+
+
+async def _h_set_cfg_scale(ws, cmd):
+    global _cfg_scale
+    _cfg_scale = max(1.0, float(cmd.get("value", 1.0)))
+    _rebuild_frame_fn()
+
+
+async def _h_set_negative_prompt(ws, cmd):
+    global _negative_embeds
+    if pipeline is not None:
+        prompt = cmd.get("prompt", "")
+        _negative_embeds = pipeline._encode_single(prompt)
+
+
+async def _h_set_num_steps(ws, cmd):
+    global _num_steps
+    _num_steps = max(1, min(8, int(cmd.get("value", 1))))
+    _rebuild_frame_fn()
+
+
+async def _h_ping(ws, cmd):
+    await ws.send(json.dumps({"type": "pong"}))
+
+
+_HANDLERS = {
+    "set_prompt": _h_set_prompt,
+    "set_feedback": _h_set_feedback,
+    "set_strength": _h_set_strength,
+    "set_lerp_speed": _h_set_lerp_speed,
+    "set_seed": _h_set_seed,
+    "set_cfg_scale": _h_set_cfg_scale,
+    "set_negative_prompt": _h_set_negative_prompt,
+    "set_num_steps": _h_set_num_steps,
+    "ping": _h_ping,
+}
 
 
 async def handle_command(ws, cmd):
     """Handle a JSON command from the client."""
-    global pipeline, _cfg_scale, _num_steps, _negative_embeds
     t = cmd.get("type")
-    if t == "set_prompt":
-        prompt = cmd.get("prompt", "")
-        if prompt and pipeline is not None:
-            new_embed = pipeline._encode_single(prompt)
-            pipeline._target_embeds = new_embed
-            pipeline._current_prompt = prompt
-            await ws.send(json.dumps({"type": "prompt_set", "prompt": prompt}))
-    elif t == "set_feedback":
-        if pipeline is not None:
-            pipeline.latent_feedback = float(cmd.get("value", 0.1))
-    elif t == "set_strength":
-        set_strength(float(cmd.get("value", 0.5)))
-    elif t == "set_lerp_speed":
-        if pipeline is not None:
-            pipeline._prompt_lerp_speed = float(cmd.get("value", 0.05))
-    elif t == "set_seed":
-        if pipeline is not None:
-            seed = int(cmd.get("value", 42))
-            pipeline._fixed_noise = np.random.RandomState(seed).randn(
-                *pipeline._fixed_noise.shape
-            ).astype(pipeline._fixed_noise.dtype)
-    elif t == "set_cfg_scale":
-        _cfg_scale = max(1.0, float(cmd.get("value", 1.0)))
-    elif t == "set_negative_prompt":
-        if pipeline is not None:
-            prompt = cmd.get("prompt", "")
-            _negative_embeds = pipeline._encode_single(prompt)
-    elif t == "set_num_steps":
-        _num_steps = max(1, min(8, int(cmd.get("value", 1))))
-    elif t == "ping":
-        await ws.send(json.dumps({"type": "pong"}))
+    if not isinstance(t, str):
+        return
+    handler = _HANDLERS.get(t)
+    if handler is not None:
+        await handler(ws, cmd)
 
 
 async def main_async(args):
-    global pipeline, _alphas_cumprod, _max_timestep, _negative_embeds
+    global pipeline, _alphas_cumprod, _max_timestep, _negative_embeds, _unet_cfg_batch
+    global _img_buf, _norm_lut_bits, _vae_out_lut, _t_buf
+    global _latent_buf, _x_buf, _npred_buf, _npred_uncond_buf, _tmp_buf
+    global _cfg_sample, _cfg_t_buf, _cfg_embeds, _embeds_diff, _embeds_abs
+    global _inference_lock
 
     print("LOADING", flush=True)
 
@@ -285,6 +826,31 @@ async def main_async(args):
         ),
     )
 
+    # Preprocessing buffers for the advanced path
+    size = pipeline.render_size
+    _img_buf = np.empty((1, 3, size, size), dtype=np.float16)
+    _norm_lut_bits = _norm_lut_as_bits(pipeline._norm_lut)
+    _vae_out_lut = _compute_vae_out_lut()
+    _t_buf = np.empty((1,), dtype=np.float16)
+    _latent_buf = np.empty_like(pipeline._fixed_noise)
+    _x_buf = np.empty_like(pipeline._fixed_noise)
+    _npred_buf = np.empty_like(pipeline._fixed_noise)
+    _npred_uncond_buf = np.empty_like(pipeline._fixed_noise)
+    _tmp_buf = np.empty_like(pipeline._fixed_noise)
+
+    # Batched CFG needs a UNet converted with batch 1 and 2 enumerated;
+    # older fixed-batch conversions keep the two-pass path.
+    _unet_cfg_batch = _model_accepts_batch(
+        pipeline.unet, ("sample", "timestep", "encoder_hidden_states"), 2
+    )
+    latent_shape = pipeline._fixed_noise.shape[1:]
+    embeds_shape = pipeline._prompt_embeds.shape[1:]
+    _cfg_sample = np.empty((2,) + latent_shape, dtype=pipeline._fixed_noise.dtype)
+    _cfg_t_buf = np.empty((2,), dtype=np.float16)
+    _cfg_embeds = np.empty((2,) + embeds_shape, dtype=pipeline._prompt_embeds.dtype)
+    _embeds_diff = np.empty_like(pipeline._prompt_embeds)
+    _embeds_abs = np.empty_like(pipeline._prompt_embeds)
+
     # Compute noise schedule. Use the full 1000-step range (0–999) regardless
     # of what the pipeline's scheduler was initialized with. SDXS uses Euler
     # with t≈999; SD Turbo uses DDPM with t≈499. Both CoreML UNets were traced
@@ -295,6 +861,8 @@ async def main_async(args):
     # Apply initial strength (SDEdit: adjusts noise level + timestep)
     set_strength(args.strength)
 
+    _inference_lock = asyncio.Lock()
+
     # Encode empty string as default unconditional embedding for CFG
     _negative_embeds = pipeline._encode_single("")
     # Start WebSocket server
@@ -306,7 +874,18 @@ async def main_async(args):
     loop.add_signal_handler(signal.SIGTERM, signal_handler)
     loop.add_signal_handler(signal.SIGINT, signal_handler)
 
-    async with websockets.serve(handle_client, "127.0.0.1", args.port):
+    # JPEG frames are incompressible, so per-message deflate only burns CPU.
+    # max_queue=2 keeps stale frames from piling up behind slow inference;
+    # max_size allows large canvases (the 1 MiB default rejects them).
+    async with websockets.serve(
+        handle_client,
+        "127.0.0.1",
+        args.port,
+        compression=None,
+        max_size=8 * 1024 * 1024,
+        max_queue=2,
+        write_limit=2 ** 20,
+    ):
         print(f"READY:{args.port}", flush=True)
 
         # Redirect stdout to stderr — Rust closes the stdout pipe after
@@ -332,7 +911,10 @@ def main():
     parser.add_argument("--coreml-dir", type=str, default=None)
     args = parser.parse_args()
 
-    asyncio.run(main_async(args))
+    if uvloop is not None:
+        uvloop.run(main_async(args))
+    else:
+        asyncio.run(main_async(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Palettize a converted CoreML UNet to n-bit (default 6-bit) weights.
+
+The UNet step is bound by weight loads; k-means palettized weights stay
+compressed in memory and are expanded per layer at predict time, cutting
+memory bandwidth on the ANE/GPU. The output is a drop-in replacement for
+the fp16 model — diffusion_server.py needs no changes to use it.
+
+Run after convert_models.py, with the same venv (needs coremltools >= 7):
+
+    python palettize_models.py
+    python palettize_models.py --model path/to/unet.mlpackage --nbits 4
+
+The original package is kept next to it as <name>.fp16.mlpackage.
+"""
+import argparse
+import os
+import shutil
+
+import coremltools as ct
+from coremltools.optimize.coreml import (
+    OpPalettizerConfig,
+    OptimizationConfig,
+    palettize_weights,
+)
+
+
+def palettize(path, nbits):
+    """Palettize the mlpackage at path in place, keeping an fp16 backup.
+
+    Re-running always starts from the fp16 backup, so weights are never
+    palettized twice.
+    """
+    path = os.path.normpath(path)
+    stem, ext = os.path.splitext(path)
+    backup = f"{stem}.fp16{ext}"
+    tmp = f"{stem}.palettized{ext}"
+    source = backup if os.path.exists(backup) else path
+
+    mlmodel = ct.models.MLModel(source, skip_model_load=True)
+    config = OptimizationConfig(
+        global_config=OpPalettizerConfig(mode="kmeans", nbits=nbits)
+    )
+    palettize_weights(mlmodel, config=config).save(tmp)
+
+    if os.path.exists(backup):
+        shutil.rmtree(path)
+    else:
+        os.rename(path, backup)
+    os.rename(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Palettize CoreML UNet weights")
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "streamdiffusion-mac",
+            "coreml_models",
+            "unet.mlpackage",
+        ),
+    )
+    parser.add_argument("--nbits", type=int, default=6, choices=(1, 2, 3, 4, 6, 8))
+    args = parser.parse_args()
+
+    palettize(args.model, args.nbits)
+    print(f"Palettized {args.model} to {args.nbits}-bit weights")
+
+
+if __name__ == "__main__":
+    main()